@@ -35,13 +35,16 @@ VERSION = "2.0"
 
 import os, re, sys, json, time, traceback, marshal, hashlib
 import errno, socket, select, threading, Queue, ctypes
-import pyinotify, requests
+import binascii, struct, itertools, weakref
+import pyinotify
 from functools import wraps
-from collections import namedtuple
+from bisect import bisect_right
+from collections import namedtuple, OrderedDict
 from tempfile import NamedTemporaryFile
 from hosted.scheduler import timespec_from_config
 
 _types = {}
+_identity_types = set()
 
 class OptionValueWrapper(object):
     def __init__(self, value):
@@ -55,10 +58,24 @@ class OptionExpandedSchedule(object):
     def __init__(self, value, schedules):
         self._value = value
         self._schedules = schedules
+        self._index = None
 
     def within_range(self, start, duration, probe):
         return start <= probe < start + duration
 
+    def build_index(self):
+        # Start times for bisecting, and the latest end time of all
+        # spans up to each position. The latter allows stopping the
+        # backwards scan as soon as no earlier span can still cover
+        # the probed time.
+        expanded = self._schedules['expanded'][self._value]
+        starts, max_ends, max_end = [], [], float('-inf')
+        for start, duration in expanded:
+            max_end = max(max_end, start + duration)
+            starts.append(start)
+            max_ends.append(max_end)
+        self._index = expanded, starts, max_ends
+
     def is_active_at(self, unix_time):
         if self._value == 'always':
             return True
@@ -67,11 +84,15 @@ class OptionExpandedSchedule(object):
         start, duration = self._schedules['range']
         if not self.within_range(start, duration, unix_time):
             return False
-        for start, duration in self._schedules['expanded'][self._value]:
-            if start > unix_time:
-                return False
-            elif self.within_range(start, duration, unix_time):
+        if self._index is None:
+            self.build_index()
+        expanded, starts, max_ends = self._index
+        idx = bisect_right(starts, unix_time) - 1
+        while idx >= 0 and max_ends[idx] > unix_time:
+            start, duration = expanded[idx]
+            if self.within_range(start, duration, unix_time):
                 return True
+            idx -= 1
         return False
 
 def init_types():
@@ -79,15 +100,19 @@ def init_types():
         _types[fn.__name__] = fn
         return fn
 
-    @type
+    def identity(fn):
+        _identity_types.add(fn.__name__)
+        return type(fn)
+
+    @identity
     def color(value):
         return value
 
-    @type
+    @identity
     def string(value):
         return value
 
-    @type
+    @identity
     def text(value):
         return value
 
@@ -95,63 +120,63 @@ def init_types():
     def section(value):
         return OptionSection(value)
 
-    @type
+    @identity
     def boolean(value):
         return value
 
-    @type
+    @identity
     def select(value):
         return value
 
-    @type
+    @identity
     def duration(value):
         return value
 
-    @type
+    @identity
     def integer(value):
         return value
 
-    @type
+    @identity
     def float(value):
         return value
 
-    @type
+    @identity
     def font(value):
         return value
 
-    @type
+    @identity
     def device(value):
         return value
 
-    @type
+    @identity
     def resource(value):
         return value
 
-    @type
+    @identity
     def device_token(value):
         return value
 
-    @type
+    @identity
     def json(value):
         return value
 
-    @type
+    @identity
     def id(value):
         return value
 
-    @type
+    @identity
     def playlist(value):
         return value
 
-    @type
+    @identity
     def list_select(value):
         return value
 
-    @type
+    @identity
     def custom(value):
         return value
 
-    @type
+    @identity
     def date(value):
         return value
 
@@ -175,36 +200,59 @@ def abort_service(reason):
     os.kill(os.getpid(), 9)
     time.sleep(100)
 
-CLOCK_MONOTONIC_RAW = 4 # see <linux/time.h>
+# Compact and ASCII-only, so the result can be sent or
+# written as is without another encoding pass.
+try:
+    import ujson
+    def _dumps(data):
+        return ujson.dumps(data, ensure_ascii=True)
+except ImportError:
+    def _dumps(data):
+        return json.dumps(data, separators=(',',':'))
+
+if hasattr(hashlib, 'blake2b'):
+    def _digest(data):
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+else:
+    def _digest(data):
+        return hashlib.md5(data).hexdigest()
 
-class timespec(ctypes.Structure):
-    _fields_ = [
-        ('tv_sec', ctypes.c_long),
-        ('tv_nsec', ctypes.c_long),
-    ]
+CLOCK_MONOTONIC_RAW = 4 # see <linux/time.h>
 
-_librt = ctypes.CDLL('librt.so.1')
-_clock_gettime = _librt.clock_gettime
-_clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+if hasattr(time, 'clock_gettime'):
+    def monotonic_time():
+        return time.clock_gettime(CLOCK_MONOTONIC_RAW)
+else:
+    class timespec(ctypes.Structure):
+        _fields_ = [
+            ('tv_sec', ctypes.c_long),
+            ('tv_nsec', ctypes.c_long),
+        ]
+
+    _librt = ctypes.CDLL('librt.so.1')
+    _clock_gettime = _librt.clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    _byref = ctypes.byref
+
+    # The timespec is allocated per call: a shared one could be
+    # overwritten by another thread while the GIL is released.
+    def monotonic_time():
+        t = timespec()
+        _clock_gettime(CLOCK_MONOTONIC_RAW, _byref(t))
+        return t.tv_sec + t.tv_nsec * 1e-9
 
-def monotonic_time():
-    t = timespec()
-    _clock_gettime(CLOCK_MONOTONIC_RAW , ctypes.pointer(t))
-    return t.tv_sec + t.tv_nsec * 1e-9
+def get_random_bytes(num_bytes):
+    return os.urandom(num_bytes)
 
-_libc = ctypes.CDLL('libc.so.6')
-_getrandom = _libc.getrandom
-_getrandom.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+# Buffer size for info-beamer query connections. Multi-line
+# responses and raw node connections handed out by Node.io()
+# then read from memory instead of issuing small recv calls.
+IB_BUFSIZE = 1024 * 1024
 
-_create_string_buffer = ctypes.create_string_buffer
-_string_at = ctypes.string_at
+# Idle query connections are reopened instead of reused.
+IB_MAX_IDLE = 60
 
-def get_random_bytes(num_bytes):
-    buf = _create_string_buffer(num_bytes)
-    result = _getrandom(buf, num_bytes, 0)
-    if result != num_bytes:
-        raise OSError("Error getting random bytes from getrandom")
-    return _string_at(buf, num_bytes)
+_HANDSHAKE_RE = re.compile("^Info Beamer PI ([^ ]+)")
 
 class InfoBeamerQueryException(Exception):
     pass
@@ -217,13 +265,17 @@ class InfoBeamerQuery(object):
         self._port = port
         self._timeout = 2
         self._version = None
+        self._lock = threading.RLock()
+        self._last_used = 0
 
     def _reconnect(self):
         if self._conn is not None:
-            return
+            if monotonic_time() < self._last_used + IB_MAX_IDLE:
+                return
+            self._reset()
         try:
             self._sock = socket.create_connection((self._host, self._port), self._timeout)
-            self._conn = self._sock.makefile()
+            self._conn = self._sock.makefile('rwb', IB_BUFSIZE)
             intro = self._conn.readline()
         except socket.timeout:
             self._reset()
@@ -232,11 +284,12 @@ class InfoBeamerQuery(object):
             self._reset()
             raise InfoBeamerQueryException("Cannot connect to %s:%s: %s" % (
                 self._host, self._port, err))
-        m = re.match("^Info Beamer PI ([^ ]+)", intro)
+        m = _HANDSHAKE_RE.match(intro)
         if not m:
             self._reset()
             raise InfoBeamerQueryException("Invalid handshake. Not info-beamer?")
         self._version = m.group(1)
+        self._last_used = monotonic_time()
 
     def _parse_line(self):
         line = self._conn.readline()
@@ -245,6 +298,9 @@ class InfoBeamerQuery(object):
         return line.rstrip()
 
     def _parse_multi_line(self):
+        # Collect lines and join once. Growing a single string with
+        # += copies the whole response for each line, which gets
+        # quadratic for long Lua tracebacks.
         lines = []
         while 1:
             line = self._conn.readline()
@@ -254,9 +310,15 @@ class InfoBeamerQuery(object):
             if not line:
                 break
             lines.append(line)
-        return '\n'.join(lines)
+        return b'\n'.join(lines)
 
     def _send_cmd(self, min_version, cmd, multiline=False):
+        with self._lock:
+            response = self._send_cmd_locked(min_version, cmd, multiline)
+            self._last_used = monotonic_time()
+            return response
+
+    def _send_cmd_locked(self, min_version, cmd, multiline):
         for retry in (1, 2):
             self._reconnect()
             if self._version <= min_version:
@@ -394,14 +456,18 @@ class InfoBeamerQuery(object):
 
         def io(self, raw=True):
             "creates a tcp connection to this node"
-            status = self._ib._send_cmd(
-                "0.6", "%s%s" % ("*raw/" if raw else '', self._path),
-            )
-            if status != 'ok!':
-                raise InfoBeamerQueryException("Cannot connect to node %s" % self._path)
-            sock = self._ib._sock
+            with self._ib._lock:
+                status = self._ib._send_cmd(
+                    "0.6", "%s%s" % ("*raw/" if raw else '', self._path),
+                )
+                if status != 'ok!':
+                    raise InfoBeamerQueryException("Cannot connect to node %s" % self._path)
+                # The connection now belongs to the node. Detach it
+                # so the next query opens a fresh one.
+                sock, conn = self._ib._sock, self._ib._conn
+                self._ib._reset(close=False)
             sock.settimeout(None)
-            return self._ib._conn
+            return conn
 
         @property
         def has_error(self):
@@ -426,6 +492,16 @@ class InfoBeamerQuery(object):
     def __repr__(self):
         return "<info-beamer@%s>" % self.addr
 
+_ib_pool = {}
+_ib_pool_lock = threading.Lock()
+
+def get_ib(host='127.0.0.1', port=4444):
+    with _ib_pool_lock:
+        ib = _ib_pool.get((host, port))
+        if ib is None:
+            ib = _ib_pool[host, port] = InfoBeamerQuery(host, port)
+        return ib
+
 class ParsedConfig(object):
     def __init__(self, parsed):
         self._parsed = parsed
@@ -464,14 +540,42 @@ class ParsedConfig(object):
             self.config_hash, self.config_rev,
         )
 
+# Kinds of entries in a compiled options plan
+_PLAN_IDENTITY, _PLAN_CONVERT, _PLAN_LIST, _PLAN_EXPANDED_SCHEDULE = range(4)
+
+def _compile_plan(options, expanded_schedules):
+    # Turns the options of node.json into a list of
+    # (name, kind, handler or sub plan) tuples, so parsing
+    # config.json doesn't have to inspect the options again.
+    plan = []
+    for option in options:
+        if not 'name' in option:
+            continue
+        if option['type'] == 'list':
+            plan.append((option['name'], _PLAN_LIST, _compile_plan(
+                option['items'], expanded_schedules
+            )))
+        elif option['type'] == 'schedule' and expanded_schedules:
+            plan.append((option['name'], _PLAN_EXPANDED_SCHEDULE, None))
+        elif option['type'] in _identity_types:
+            plan.append((option['name'], _PLAN_IDENTITY, None))
+        else:
+            plan.append((option['name'], _PLAN_CONVERT, _types[option['type']]))
+    return plan
+
 class Configuration(object):
     def __init__(self, path=''):
         self._path = path
+        self._node_path = os.path.join(path, "node.json")
+        self._config_path = os.path.join(path, "config.json")
         self._restart = False
-        with open(os.path.join(self._path, "node.json")) as f:
-            node_json = json.load(f)
+        self._digest = None
+        self._parse_lock = threading.Lock()
+        with open(self._node_path, 'rb') as f:
+            node_json = json.loads(f.read())
             self._expanded_schedules = node_json.get('expand_schedules', False)
             self._options = node_json.get('options', [])
+        self._plan = _compile_plan(self._options, self._expanded_schedules)
         self.parse_config_json()
 
     @property
@@ -483,8 +587,20 @@ class Configuration(object):
         self._restart = True
 
     def parse_config_json(self):
-        with open(os.path.join(self._path, "config.json")) as f:
-            config = json.load(f)
+        # Called from the config watcher thread as well as by users
+        # of this class, so _digest and _parsed are updated together.
+        with self._parse_lock:
+            self._parse_config_json()
+
+    def _parse_config_json(self):
+        with open(self._config_path, 'rb') as f:
+            raw = f.read()
+
+        digest = _digest(raw)
+        if digest == self._digest:
+            log("%s unchanged" % self._config_path)
+            return
+        config = json.loads(raw)
 
         if self._restart:
             return abort_service("restart_on_update set")
@@ -500,29 +616,30 @@ class Configuration(object):
 
         schedules = config.get('__schedules')
 
-        def parse_recursive(options, config):
+        def parse_recursive(plan, config):
             parsed = {}
-            for option in options:
-                if not 'name' in option or not option['name'] in config:
-                    continue
-                if option['type'] == 'list':
-                    items = []
-                    for item in config[option['name']]:
-                        items.append(parse_recursive(option['items'], item))
-                    parsed[option['name']] = items
+            for name, kind, handler in plan:
+                if not name in config:
                     continue
-                if option['type'] == 'schedule' and self._expanded_schedules:
-                    parsed[option['name']] = OptionExpandedSchedule(
-                        config[option['name']], schedules
-                    )
+                value = config[name]
+                if kind == _PLAN_IDENTITY:
+                    parsed[name] = value
+                elif kind == _PLAN_CONVERT:
+                    parsed[name] = handler(value)
+                elif kind == _PLAN_LIST:
+                    parsed[name] = [
+                        parse_recursive(handler, item)
+                        for item in value
+                    ]
                 else:
-                    parsed[option['name']] = _types[option['type']](config[option['name']])
+                    parsed[name] = OptionExpandedSchedule(value, schedules)
             return parsed
 
-        parsed = parse_recursive(self._options, config)
+        parsed = parse_recursive(self._plan, config)
         parsed['__metadata'] = parse_metadata(config['__metadata'])
-        log("updated %s" % os.path.join(self._path, 'config.json'))
+        log("updated %s" % self._config_path)
         self._parsed, self._config = ParsedConfig(parsed), config
+        self._digest = digest
 
     @property
     def raw(self):
@@ -541,11 +658,9 @@ class Configuration(object):
 class ConfigWatcherEventHandler(pyinotify.ProcessEvent):
     def my_init(self, watcher):
         self._watcher = watcher
-        self._lock = threading.Lock()
 
     def process_default(self, event):
-        with self._lock:
-            self._watcher.on_changed(event.pathname)
+        self._watcher.on_changed(event.pathname)
 
 class ConfigWatcher(object):
     def __init__(self):
@@ -598,7 +713,7 @@ class RPC(object):
     def _get_connection(self):
         if self._con is None:
             try:
-                self._con = InfoBeamerQuery().node(
+                self._con = get_ib().node(
                     self._path + "/rpc/python"
                 ).io(raw=True)
             except InfoBeamerQueryException:
@@ -627,31 +742,32 @@ class RPC(object):
             self._close_connection()
             return False
 
-    def _recv(self):
-        with self._lock:
-            con = self._get_connection()
+    def _dispatch(self, line):
         try:
-            return con.readline()
+            args = json.loads(line)
+            method = args.pop(0)
+            callback = self._callbacks.get(method)
+            if callback:
+                callback(*args)
+            else:
+                log("callback '%s' not found" % (method,))
         except:
-            self._close_connection()
+            traceback.print_exc()
 
     def _listen_thread(self):
         while 1:
-            line = self._recv()
-            if not line:
-                self._close_connection()
-                time.sleep(0.5)
-                continue
-            try:
-                args = json.loads(line)
-                method = args.pop(0)
-                callback = self._callbacks.get(method)
-                if callback:
-                    callback(*args)
-                else:
-                    log("callback '%s' not found" % (method,))
-            except:
-                traceback.print_exc()
+            with self._lock:
+                con = self._get_connection()
+            if con is not None:
+                # The connection is buffered (see IB_BUFSIZE), so
+                # most lines are returned without a recv call.
+                try:
+                    for line in iter(con.readline, b''):
+                        self._dispatch(line)
+                except:
+                    pass
+            self._close_connection()
+            time.sleep(0.5)
 
     def register(self, name, fn):
         self._callbacks[name] = fn
@@ -666,22 +782,36 @@ class RPC(object):
         def call(*args):
             args = list(args)
             args.insert(0, method)
-            return self._send(json.dumps(
-                args,
-                ensure_ascii=False,
-                separators=(',',':'),
-            ).encode('utf8'))
+            return self._send(_dumps(args))
         return call
 
     get_method = __getattr__
 
+# The scandir backport streams directory entries instead of
+# building the full list os.listdir returns.
+try:
+    from scandir import scandir
+    def _iter_dir(path):
+        for entry in scandir(path):
+            yield entry.name
+except ImportError:
+    _iter_dir = os.listdir
+
 class Cache(object):
+    MAX_FNAMES = 1024
+
     def __init__(self, scope='default'):
         self._touched = set()
         self._prefix = 'cache-%s-' % scope
+        self._fnames = {}
 
     def key_to_fname(self, key):
-        return self._prefix + hashlib.md5(key).hexdigest()
+        fname = self._fnames.get(key)
+        if fname is None:
+            if len(self._fnames) >= self.MAX_FNAMES:
+                self._fnames.clear()
+            fname = self._fnames[key] = self._prefix + _digest(key)
+        return fname
 
     def has(self, key, max_age=None):
         try:
@@ -713,8 +843,17 @@ class Cache(object):
         return json.loads(data)
 
     def set(self, key, value):
-        with open(self.file_ref(key), "wb") as f:
+        f = NamedTemporaryFile(prefix='.cache-tmp', dir='.')
+        try:
             f.write(value)
+        except:
+            traceback.print_exc()
+            f.close()
+            raise
+        else:
+            f.delete = False
+            f.close()
+            os.rename(f.name, self.file_ref(key))
 
     def set_json(self, key, data):
         self.set(key, json.dumps(data))
@@ -728,11 +867,10 @@ class Cache(object):
         self._touched = set()
 
     def prune(self):
-        existing = set()
-        for fname in os.listdir("."):
-            if not fname.startswith(self._prefix):
-                continue
-            existing.add(fname)
+        existing = set(
+            fname for fname in _iter_dir(".")
+            if fname.startswith(self._prefix)
+        )
         prunable = existing - self._touched
         for fname in prunable:
             try:
@@ -786,26 +924,37 @@ class NodeServiceDataHandler(object):
         thread.daemon = True
         thread.start()
 
+    # Callbacks are replaced, never modified, so the listen
+    # thread can read them without taking the lock.
     def register_callbacks(self, callbacks):
         with self._lock:
-            self._callbacks.update(callbacks)
+            updated = dict(self._callbacks)
+            updated.update(callbacks)
+            self._callbacks = updated
 
     def remove_callback(self, path):
         with self._lock:
             if path in self._callbacks:
-                del self._callbacks[path]
+                updated = dict(self._callbacks)
+                del updated[path]
+                self._callbacks = updated
 
     def _listen_thread(self):
+        buf = bytearray(2**16)
+        view = memoryview(buf)
         while 1:
             try:
-                pkt, _ = self._sock.recvfrom(2**16)
-                path, data = pkt.split(':', 1)
-                with self._lock:
-                    callback = self._callbacks.get(path)
-                    if callback:
-                        callback(data)
-                    else:
-                        log("callback '%s' not found" % (path,))
+                size = self._sock.recv_into(buf)
+                sep = buf.find(b':', 0, size)
+                if sep == -1:
+                    log("invalid service data packet")
+                    continue
+                path = view[:sep].tobytes()
+                callback = self._callbacks.get(path)
+                if callback:
+                    callback(view[sep+1:size].tobytes())
+                else:
+                    log("callback '%s' not found" % (path,))
             except Exception as err:
                 traceback.print_exc()
 
@@ -813,22 +962,24 @@ class Node(object):
     def __init__(self, node):
         self._node = node
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.connect(('127.0.0.1', 4444))
         self._rpc = None
         self._service_data = None
 
     def send_raw(self, raw):
         log("sending %r" % (raw,))
-        self._sock.sendto(raw, ('127.0.0.1', 4444))
+        try:
+            self._sock.send(raw)
+        except socket.error as err:
+            # A connected UDP socket reports ICMP errors (like
+            # info-beamer not listening yet) on the next send.
+            log("cannot send to info-beamer: %s" % (err,))
 
     def send(self, data):
         self.send_raw(self._node + data)
 
     def send_json(self, path, data):
-        self.send('%s:%s' % (path, json.dumps(
-            data,
-            ensure_ascii=False,
-            separators=(',',':'),
-        ).encode('utf8')))
+        self.send(path + ':' + _dumps(data))
 
     @property
     def is_top_level(self):
@@ -852,11 +1003,7 @@ class Node(object):
             os.rename(f.name, filename)
 
     def write_json(self, filename, data):
-        self.write_file(filename, json.dumps(
-            data,
-            ensure_ascii=False,
-            separators=(',',':'),
-        ).encode('utf8'))
+        self.write_file(filename, _dumps(data))
 
     class Sender(object):
         def __init__(self, node, path):
@@ -876,8 +1023,7 @@ class Node(object):
         return self.Sender(self, '')(data)
 
     def connect(self, suffix=""):
-        ib = InfoBeamerQuery()
-        return ib.node(self.path + suffix).io(raw=True)
+        return get_ib().node(self.path + suffix).io(raw=True)
 
     def rpc(self, **callbacks):
         if not self._rpc:
@@ -917,6 +1063,31 @@ class Node(object):
                 pass
         os.symlink(cached, filename)
 
+def _create_session(user_agent, pool_connections, pool_maxsize, retries=0):
+    import requests
+    if retries:
+        from requests.packages.urllib3.util.retry import Retry
+        max_retries = Retry(
+            total = retries,
+            backoff_factor = 0.2,
+            status_forcelist = [502, 503, 504],
+            raise_on_status = False,
+        )
+    else:
+        max_retries = 0
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections = pool_connections,
+        pool_maxsize = pool_maxsize,
+        max_retries = max_retries,
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if user_agent is not None:
+        session.headers['User-Agent'] = user_agent
+    session.headers['Connection'] = 'keep-alive'
+    return session
+
 class APIError(Exception):
     pass
 
@@ -991,14 +1162,12 @@ class OnDeviceAPIs(object):
         self._index = None
         self._valid_until = 0
         self._lock = threading.Lock()
-        self._session = requests.Session()
-        self._session.headers.update({
-            'User-Agent': 'hosted.py version/%s' % (VERSION,)
-        })
+        self._session = None
+        self._session_lock = threading.Lock()
 
     def update_apis(self):
         log("fetching api index")
-        r = self._session.get(
+        r = self.session.get(
             url = self._config.metadata['api'],
             timeout = 5,
         )
@@ -1018,7 +1187,15 @@ class OnDeviceAPIs(object):
 
     @property
     def session(self):
-        return self._session
+        # Created on first use, so services that never call an
+        # API don't have to import requests.
+        with self._session_lock:
+            if self._session is None:
+                self._session = _create_session(
+                    'hosted.py version/%s' % (VERSION,),
+                    pool_connections=32, pool_maxsize=32,
+                )
+            return self._session
 
     def list(self):
         try:
@@ -1034,53 +1211,144 @@ class OnDeviceAPIs(object):
         return APIProxy(self, api_name)
 
 class HostedAPI(object):
+    PREFETCH_CHECK = 5
+    PREFETCH_AHEAD = 30
+
     def __init__(self, api, on_device_token):
         self._api = api
         self._on_device_token = on_device_token
         self._lock = threading.Lock()
+        self._refreshing = False
+        self._refresh_event = threading.Event()
         self._next_refresh = 0
-        self._api_key = None
-        self._uses = 0
-        self._expire = 0
-        self._base_url = None
-        self._session = requests.Session()
-        self._session.headers.update({
-            'User-Agent': 'hosted.py version/%s - on-device' % (VERSION,)
-        })
+        self._next_prefetch = 0
+        self._last_use = 0
+        # (api_key, uses, expire, use counter, base_url, fetched).
+        # Replaced as a whole when a new key is fetched, so it can be
+        # read without the lock. itertools.count is advanced
+        # atomically in CPython.
+        self._key = (None, 0, 0, itertools.count(1), None, 0)
+        self._session = _create_session(
+            'hosted.py version/%s - on-device' % (VERSION,),
+            pool_connections=4, pool_maxsize=16, retries=2,
+        )
+        # Only a weak reference is handed to the thread, so it
+        # terminates once this HostedAPI is no longer used.
+        thread = threading.Thread(
+            target=HostedAPI._prefetch_thread, args=(weakref.ref(self),)
+        )
+        thread.daemon = True
+        thread.start()
 
-    def use_api_key(self):
+    @staticmethod
+    def _prefetch_thread(ref):
+        while 1:
+            time.sleep(HostedAPI.PREFETCH_CHECK)
+            api = ref()
+            if api is None:
+                return
+            api._maybe_prefetch()
+            del api
+
+    def _maybe_prefetch(self):
+        # Fetch a new key shortly before the current one expires, so
+        # foreground requests don't have to wait for the refresh.
+        # Only done for keys that are actually in use and live long
+        # enough for prefetching to make sense.
+        api_key, uses, expire, counter, base_url, fetched = self._key
+        if api_key is None or self._last_use < fetched:
+            return
+        if expire - fetched <= self.PREFETCH_AHEAD:
+            return
+        now = time.time()
+        if expire - now > self.PREFETCH_AHEAD:
+            return
         with self._lock:
-            now = time.time()
-            self._uses -= 1
-            if self._uses <= 0:
-                log('hosted API adhoc key used up')
-                self._api_key = None
-            elif now > self._expire:
-                log('hosted API adhoc key expired')
-                self._api_key = None
-            else:
-                log('hosted API adhoc key usage: %d uses, %ds left' %(
-                    self._uses, self._expire - now
-                ))
-            if self._api_key is None:
-                if time.time() < self._next_refresh:
-                    return None
-                log('refreshing hosted API adhoc key')
-                self._next_refresh = time.time() + 15
-                try:
-                    r = self._api['api_key'].get(
-                        params = dict(
-                            on_device_token = self._on_device_token
-                        ),
-                        timeout = 5,
-                    )
-                except:
+            if self._refreshing or now < self._next_prefetch:
+                return
+            # Separate from _next_refresh, so a failed prefetch
+            # doesn't delay refreshes by foreground requests.
+            self._next_prefetch = now + 15
+            self._refreshing = True
+            self._refresh_event.clear()
+        log('prefetching hosted API adhoc key')
+        self._refresh_api_key()
+
+    def _take_use(self, key):
+        api_key, uses, expire, counter, base_url, fetched = key
+        if api_key is None:
+            return None
+        used, now = next(counter), time.time()
+        if used >= uses:
+            log('hosted API adhoc key used up')
+            return None
+        elif now > expire:
+            log('hosted API adhoc key expired')
+            return None
+        log('hosted API adhoc key usage: %d uses, %ds left' %(
+            uses - used, expire - now
+        ))
+        self._last_use = now
+        return api_key, base_url
+
+    def _use_key(self):
+        # Returns (api_key, base_url) taken from the same key
+        # snapshot, or None if no usable key is available.
+        key = self._key
+        use = self._take_use(key)
+        if use is not None:
+            return use
+        with self._lock:
+            if self._key is not key:
+                # Replaced by another thread in the meantime
+                use = self._take_use(self._key)
+                if use is not None:
+                    return use
+            if not self._refreshing:
+                now = time.time()
+                if now < self._next_refresh:
                     return None
-                self._api_key = r['api_key']
-                self._uses = r['uses']
-                self._expire = now + r['expire'] - 1
-                self._base_url = r['base_url']
-            return self._api_key
+                self._next_refresh = now + 15
+                self._refreshing = True
+                self._refresh_event.clear()
+                refresh = True
+            else:
+                refresh = False
+        if refresh:
+            return self._refresh_api_key()
+        # Another thread is already fetching a new key. Wait for
+        # its result instead of sending a request of our own.
+        self._refresh_event.wait(5)
+        return self._take_use(self._key)
+
+    def _refresh_api_key(self):
+        # Called with _refreshing set. The request runs without
+        # holding the lock, so other threads aren't blocked on it.
+        log('refreshing hosted API adhoc key')
+        now = time.time()
+        try:
+            r = self._api['api_key'].get(
+                params = dict(
+                    on_device_token = self._on_device_token
+                ),
+                timeout = 5,
+            )
+            key = (
+                r['api_key'], r['uses'], now + r['expire'] - 1,
+                itertools.count(1), r['base_url'], now,
+            )
+        except:
+            key = None
+        with self._lock:
+            if key is not None:
+                self._key = key
+            self._refreshing = False
+            self._refresh_event.set()
+        return None if key is None else (key[0], key[4])
+
+    def use_api_key(self):
+        use = self._use_key()
+        return None if use is None else use[0]
 
     def add_default_args(self, kwargs):
         if not 'timeout' in kwargs:
@@ -1088,16 +1356,19 @@ class HostedAPI(object):
         return kwargs
 
     def ensure_api_key(self, kwargs):
-        api_key = self.use_api_key()
-        if api_key is None:
+        use = self._use_key()
+        if use is None:
             raise APIError('cannot retrieve API key')
+        api_key, base_url = use
         kwargs['auth'] = ('', api_key)
+        return base_url
 
-    def get(self, endpoint, **kwargs):
+    def _request(self, method, endpoint, **kwargs):
         try:
-            self.ensure_api_key(kwargs)
-            r = self._session.get(
-                url = self._base_url + endpoint,
+            base_url = self.ensure_api_key(kwargs)
+            r = self._session.request(
+                method,
+                url = base_url + endpoint,
                 **self.add_default_args(kwargs)
             )
             r.raise_for_status()
@@ -1107,55 +1378,84 @@ class HostedAPI(object):
         except Exception as err:
             raise APIError(err)
 
+    def get(self, endpoint, **kwargs):
+        return self._request('GET', endpoint, **kwargs)
+
     def post(self, endpoint, **kwargs):
-        try:
-            self.ensure_api_key(kwargs)
-            r = self._session.post(
-                url = self._base_url + endpoint,
-                **self.add_default_args(kwargs)
-            )
-            r.raise_for_status()
-            return r.json()
-        except APIError:
-            raise
-        except Exception as err:
-            raise APIError(err)
+        return self._request('POST', endpoint, **kwargs)
 
     def delete(self, endpoint, **kwargs):
-        try:
-            self.ensure_api_key(kwargs)
-            r = self._session.delete(
-                url = self._base_url + endpoint,
-                **self.add_default_args(kwargs)
-            )
-            r.raise_for_status()
-            return r.json()
-        except APIError:
-            raise
-        except Exception as err:
-            raise APIError(err)
+        return self._request('DELETE', endpoint, **kwargs)
+
+_MISSING = object()
+
+REFRESH_INTERVAL = 3600.0
 
 class DeviceKV(object):
     class Error(Exception):
         pass
 
+    CACHE_SIZE = 1024
+    CACHE_LEASE = 300
+
     def __init__(self, api):
         self._api = api
-        self._cache = {}
-        self._cache_complete = False
+        self._cache = OrderedDict()
+        self._complete_until = 0
+        self._kv_version = None
         self._use_cache = True
-        self._next_refresh = monotonic_time() + 3600
+        self._touch()
 
     def cache_enabled(self, enabled):
         self._use_cache = enabled
-        self._cache = {}
-        self._cache_complete = False
+        self._cache = OrderedDict()
+        self._forget_complete()
+
+    # The cache is kept in least recently used order. Once it
+    # grows beyond CACHE_SIZE the oldest entries are dropped and
+    # the cache no longer knows every key. Each entry is only
+    # trusted for CACHE_LEASE seconds after it was last fetched
+    # or written, after that it is fetched again.
+    def _cache_get(self, key):
+        entry = self._cache.pop(key, _MISSING)
+        if entry is _MISSING:
+            return _MISSING
+        value, expire = entry
+        if monotonic_time() >= expire:
+            self._forget_complete()
+            return _MISSING
+        self._cache[key] = entry
+        return value
+
+    def _cache_set(self, key, value, expire=None):
+        if expire is None:
+            expire = monotonic_time() + self.CACHE_LEASE
+        self._cache.pop(key, None)
+        self._cache[key] = value, expire
+        while len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
+            self._forget_complete()
+
+    def _cache_complete(self):
+        return monotonic_time() < self._complete_until
+
+    # _kv_version is the store version the cache was last fully
+    # fetched at. It is only kept while the cache still holds
+    # every key, so it can be used to revalidate the whole cache.
+    def _forget_complete(self):
+        self._complete_until = 0
+        self._kv_version = None
+
+    def _touch(self, now=None):
+        if now is None:
+            now = monotonic_time()
+        self._next_refresh = now + REFRESH_INTERVAL
 
     def maybe_refresh(self):
         now = monotonic_time()
         if now < self._next_refresh:
             return
-        self._next_refresh = monotonic_time() + 3600
+        self._touch(now)
         try:
             self._api['kv'].post(data={})
         except Exception as err:
@@ -1163,7 +1463,8 @@ class DeviceKV(object):
 
     def __setitem__(self, key, value):
         if self._use_cache:
-            if key in self._cache and self._cache[key] == value:
+            cached = self._cache_get(key)
+            if cached is not _MISSING and cached == value:
                 self.maybe_refresh()
                 return
         try:
@@ -1173,16 +1474,17 @@ class DeviceKV(object):
                 }
             )
             if self._use_cache:
-                self._next_refresh = monotonic_time() + 3600
-                self._cache[key] = value
+                self._touch()
+                self._cache_set(key, value)
         except Exception as err:
             raise self.Error(err)
 
     def __getitem__(self, key):
         if self._use_cache:
-            if key in self._cache:
+            value = self._cache_get(key)
+            if value is not _MISSING:
                 self.maybe_refresh()
-                return self._cache[key]
+                return value
         try:
             result = self._api['kv'].get(
                 params = dict(
@@ -1194,8 +1496,8 @@ class DeviceKV(object):
                 raise KeyError(key)
             value = result[key]
             if self._use_cache:
-                self._next_refresh = monotonic_time() + 3600
-                self._cache[key] = value
+                self._touch()
+                self._cache_set(key, value)
             return value
         except KeyError:
             raise
@@ -1206,7 +1508,7 @@ class DeviceKV(object):
     # been deleted, so __delitem__ always succeeds and
     # does not throw KeyError for missing keys.
     def __delitem__(self, key):
-        if self._use_cache and self._cache_complete:
+        if self._use_cache and self._cache_complete():
             if key not in self._cache:
                 self.maybe_refresh()
                 return
@@ -1217,18 +1519,17 @@ class DeviceKV(object):
                 ),
                 timeout = 5,
             )
-            if self._use_cache and key in self._cache:
-                self._next_refresh = monotonic_time() + 3600
-                if key in self._cache:
-                    del self._cache[key]
+            if self._use_cache and self._cache.pop(key, _MISSING) is not _MISSING:
+                self._touch()
         except Exception as err:
             raise self.Error(err)
 
     def update(self, dct):
         if self._use_cache:
-            for key, value in dct.items():
-                if key in self._cache and self._cache[key] == value:
-                    dct.pop(key)
+            dct = dict(
+                (key, value) for key, value in dct.items()
+                if self._cache_get(key) != value
+            )
             if not dct:
                 self.maybe_refresh()
                 return
@@ -1237,9 +1538,9 @@ class DeviceKV(object):
                 data = dct
             )
             if self._use_cache:
-                self._next_refresh = monotonic_time() + 3600
-                for key, value in dct.iteritems():
-                    self._cache[key] = value
+                self._touch()
+                for key, value in dct.items():
+                    self._cache_set(key, value)
         except Exception as err:
             raise self.Error(err)
 
@@ -1252,18 +1553,43 @@ class DeviceKV(object):
             raise
 
     def items(self):
-        if self._use_cache and self._cache_complete:
+        if self._use_cache and self._cache_complete():
             self.maybe_refresh()
-            return self._cache.items()
+            return [
+                (key, value) for key, (value, expire)
+                in self._cache.items()
+            ]
         try:
-            result = self._api['kv'].get(
+            params = {}
+            if self._use_cache and self._kv_version is not None:
+                params['since'] = self._kv_version
+            response = self._api['kv'].get(
+                params = params,
                 timeout = 5,
-            )['v']
+            )
+            if response is None:
+                # Not modified since _kv_version: renew all leases
+                now = monotonic_time()
+                self._touch(now)
+                expire = now + self.CACHE_LEASE
+                for key, (value, _) in list(self._cache.items()):
+                    self._cache[key] = value, expire
+                self._complete_until = expire
+                return [
+                    (key, value) for key, (value, expire)
+                    in self._cache.items()
+                ]
+            result = response['v']
             if self._use_cache:
-                self._next_refresh = monotonic_time() + 3600
-                for key, value in result.iteritems():
-                    self._cache[key] = value
-                self._cache_complete = True
+                now = monotonic_time()
+                self._touch(now)
+                expire = now + self.CACHE_LEASE
+                self._cache = OrderedDict()
+                for key, value in result.items():
+                    self._cache_set(key, value, expire)
+                if len(result) <= self.CACHE_SIZE:
+                    self._complete_until = expire
+                    self._kv_version = response.get('version')
             return result.items()
         except Exception as err:
             raise self.Error(err)
@@ -1274,8 +1600,8 @@ class DeviceKV(object):
         try:
             self._api['kv'].delete()
             if self._use_cache:
-                self._cache = {}
-                self._cache_complete = False
+                self._cache = OrderedDict()
+                self._forget_complete()
         except Exception as err:
             raise self.Error(err)
 
@@ -1283,9 +1609,10 @@ class DeviceKV(object):
 class GPIO(object):
     def __init__(self):
         self._pin_fd = {}
+        self._value_fd = {}
         self._state = {}
         self._fd_2_pin = {}
-        self._poll = select.poll()
+        self._poll = select.epoll()
         self._lock = threading.Lock()
 
     def setup_pin(self, pin, direction="in", invert=False):
@@ -1309,8 +1636,13 @@ class GPIO(object):
             f.write(direction)
 
     def set_pin_value(self, pin, high):
-        with open("/sys/class/gpio/gpio%d/value" % pin, "wb") as f:
-            f.write("1" if high else "0")
+        fd = self._value_fd.get(pin)
+        if fd is None:
+            fd = self._value_fd[pin] = os.open(
+                "/sys/class/gpio/gpio%d/value" % pin, os.O_WRONLY
+            )
+        os.lseek(fd, 0, 0)
+        os.write(fd, b"1" if high else b"0")
 
     def monitor(self, pin, invert=False):
         if pin in self._pin_fd:
@@ -1322,11 +1654,13 @@ class GPIO(object):
         self._state[pin] = bool(int(os.read(fd, 5)))
         self._fd_2_pin[fd] = pin
         self._pin_fd[pin] = fd
-        self._poll.register(fd, select.POLLPRI | select.POLLERR)
+        self._poll.register(fd, select.EPOLLPRI | select.EPOLLERR | select.EPOLLET)
 
     def poll(self, timeout=1000):
         changes = []
-        for fd, evt in self._poll.poll(timeout):
+        for fd, evt in self._poll.poll(-1 if timeout is None else timeout / 1000.0):
+            if not evt & select.EPOLLPRI:
+                continue
             os.lseek(fd, 0, 0)
             state = bool(int(os.read(fd, 5)))
             pin = self._fd_2_pin[fd]
@@ -1345,9 +1679,29 @@ class GPIO(object):
         with self._lock:
             return self._state.get(pin, False)
 
+    def close(self):
+        self._poll.close()
+        for fd in list(self._pin_fd.values()) + list(self._value_fd.values()):
+            os.close(fd)
+        self._pin_fd, self._value_fd, self._fd_2_pin = {}, {}, {}
+
+_syncer_session = None
+_syncer_session_lock = threading.Lock()
+
+def _get_syncer_session():
+    # The syncer runs on localhost, so all SyncerAPI
+    # instances share one keep-alive session.
+    global _syncer_session
+    with _syncer_session_lock:
+        if _syncer_session is None:
+            _syncer_session = _create_session(
+                None, pool_connections=4, pool_maxsize=16, retries=2,
+            )
+        return _syncer_session
+
 class SyncerAPI(object):
     def __init__(self):
-        self._session = requests.Session()
+        self._session = _get_syncer_session()
 
     def unwrap(self, r):
         r.raise_for_status()
@@ -1365,7 +1719,31 @@ class SyncerAPI(object):
             data=data, timeout=10
         ))
 
+_multipart_encoder = _MISSING
+
+def _get_multipart_encoder():
+    # requests_toolbelt is optional. Python 2 doesn't remember
+    # failed imports, so the result of the lookup is kept here.
+    global _multipart_encoder
+    if _multipart_encoder is _MISSING:
+        try:
+            from requests_toolbelt import MultipartEncoder
+        except ImportError:
+            MultipartEncoder = None
+        _multipart_encoder = MultipartEncoder
+    return _multipart_encoder
+
+class ProofOfPlayEventHandler(pyinotify.ProcessEvent):
+    def my_init(self, pop):
+        self._pop = pop
+
+    def process_default(self, event):
+        self._pop.on_file_added(event.name)
+
 class ProofOfPlay(object):
+    SYNC_LINES = 16
+    SYNC_INTERVAL = 1.0
+
     def __init__(self, api, dirname):
         self._api = api
         self._prefix = os.path.join(os.environ['SCRATCH'], dirname)
@@ -1384,6 +1762,25 @@ class ProofOfPlay(object):
         self._q = Queue.Queue()
         self._log = None
 
+        # Names of submit-* files waiting for submission. Filled
+        # by inotify, so the submit thread doesn't have to list the
+        # directory on each iteration. The initial listing picks up
+        # files left over from a previous run.
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._submit_wake = threading.Event()
+        self._wm = pyinotify.WatchManager()
+        notifier = pyinotify.ThreadedNotifier(
+            self._wm, ProofOfPlayEventHandler(pop=self)
+        )
+        notifier.daemon = True
+        notifier.start()
+        self._wm.add_watch(
+            self._prefix, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+        )
+        for fname in os.listdir(self._prefix):
+            self.on_file_added(fname)
+
         thread = threading.Thread(target=self._submit_thread)
         thread.daemon = True
         thread.start()
@@ -1393,33 +1790,63 @@ class ProofOfPlay(object):
         thread.start()
 
     def _submit(self, fname, queue_size):
+        MultipartEncoder = _get_multipart_encoder()
         with open(fname, 'rb') as f:
+            if MultipartEncoder is None:
+                return self._api.pop.post(
+                    timeout = 10,
+                    data = {
+                        'queue_size': queue_size,
+                    },
+                    files={
+                        'pop-v1': f,
+                    }
+                )
+            # Streams the log file in chunks instead of building
+            # the whole request body in memory.
+            body = MultipartEncoder(fields={
+                'queue_size': str(queue_size),
+                'pop-v1': (
+                    os.path.basename(fname), f, 'application/octet-stream'
+                ),
+            })
             return self._api.pop.post(
                 timeout = 10,
-                data = {
-                    'queue_size': queue_size,
+                data = body,
+                headers = {
+                    'Content-Type': body.content_type,
                 },
-                files={
-                    'pop-v1': f,
-                }
             )
 
+    def on_file_added(self, fname):
+        if fname.startswith('submit-'):
+            with self._pending_lock:
+                self._pending.add(fname)
+            self._submit_wake.set()
+
+    def _submit_done(self, fname):
+        with self._pending_lock:
+            self._pending.discard(fname)
+
     def _submit_thread(self):
         time.sleep(3)
         while 1:
-            delay = self._submission_min_delay
+            delay, idle = self._submission_min_delay, False
             try:
                 log('[pop][submit] gathering files')
-                files = [
-                    fname for fname
-                    in os.listdir(self._prefix)
-                    if fname.startswith('submit-')
-                ]
+                with self._pending_lock:
+                    files = sorted(self._pending)
                 log('[pop][submit] %d files' % len(files))
                 for fname in files:
                     fullname = os.path.join(self._prefix, fname)
-                    if os.stat(fullname).st_size == 0:
+                    try:
+                        size = os.stat(fullname).st_size
+                    except OSError:
+                        self._submit_done(fname)
+                        continue
+                    if size == 0:
                         os.unlink(fullname)
+                        self._submit_done(fname)
                         continue
                     try:
                         log('[pop][submit] submitting %s' % fullname)
@@ -1435,13 +1862,21 @@ class ProofOfPlay(object):
                         delay = self._submission_error_delay
                         break
                     os.unlink(fullname)
+                    self._submit_done(fname)
                     break
                 if not files:
-                    delay = 10
+                    delay, idle = 10, True
             except Exception as err:
                 log('[pop][submit] error: %s' % err)
             log('[pop][submit] sleeping %ds' % delay)
-            time.sleep(delay)
+            if idle:
+                # Nothing to submit: a new file ends the wait early.
+                # Delays after a submission are kept in full, as they
+                # are the minimum delays requested by the API.
+                self._submit_wake.wait(delay)
+                self._submit_wake.clear()
+            else:
+                time.sleep(delay)
 
     def reopen_log(self):
         log_name = os.path.join(self._prefix, 'current.log')
@@ -1450,25 +1885,48 @@ class ProofOfPlay(object):
             self._log = None
         if os.path.exists(log_name):
             os.rename(log_name, os.path.join(
-                self._prefix, 'submit-%s.log' % get_random_bytes(16).encode('hex')
+                self._prefix, 'submit-%s.log' % binascii.hexlify(os.urandom(16)).decode('ascii')
             ))
-        self._log = open(log_name, 'wb')
+        # Unbuffered, so each line is a single write. Syncing is
+        # batched in _writer_thread.
+        self._log = os.fdopen(os.open(
+            log_name, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644
+        ), 'ab', 0)
         return self._log
 
+    def _sync_log(self, log_file):
+        try:
+            os.fdatasync(log_file.fileno())
+        except Exception as err:
+            log("[pop] error syncing pop log: %s" % (err,))
+        return 0, monotonic_time()
+
     def _writer_thread(self):
+        # Log lines are written right away, but only synced to disk
+        # every SYNC_LINES lines or SYNC_INTERVAL seconds and before
+        # a log is closed for submission.
         submit, log_file, lines = monotonic_time() + self._max_delay, self.reopen_log(), 0
+        unsynced, last_sync = 0, monotonic_time()
         while 1:
             reopen = False
-            max_wait = max(0.1, submit - monotonic_time())
+            now = monotonic_time()
+            if unsynced and now >= last_sync + self.SYNC_INTERVAL:
+                unsynced, last_sync = self._sync_log(log_file)
+            max_wait = max(0.1, submit - now)
+            if unsynced:
+                max_wait = min(max_wait, max(0.1, last_sync + self.SYNC_INTERVAL - now))
             log('[pop] got %d lines. waiting %ds for more log lines' % (lines, max_wait))
             try:
                 line = self._q.get(block=True, timeout=max_wait)
                 log_file.write(line + '\n')
-                log_file.flush()
-                os.fsync(log_file.fileno())
                 lines += 1
+                unsynced += 1
+                if unsynced >= self.SYNC_LINES:
+                    unsynced, last_sync = self._sync_log(log_file)
                 log('[pop] line added: %r' % line)
             except Queue.Empty:
+                if monotonic_time() < submit:
+                    continue # only woke up to sync
                 if lines == 0:
                     submit += self._max_delay # extend deadline
                 else:
@@ -1479,22 +1937,21 @@ class ProofOfPlay(object):
                 reopen = True
             if reopen:
                 log('[pop] closing log of %d lines' % lines)
+                if unsynced:
+                    unsynced, last_sync = self._sync_log(log_file)
                 submit, log_file, lines = monotonic_time() + self._max_delay, self.reopen_log(), 0
 
     def log(self, play_start, duration, asset_id, asset_filename):
-        uuid = "%08x%s" % (
-            time.time(), get_random_bytes(12).encode('hex')
-        )
-        self._q.put(json.dumps([
-                uuid,
-                play_start,
-                duration,
-                0 if asset_id is None else asset_id,
-                asset_filename,
-            ],
-            ensure_ascii = False,
-            separators = (',',':'),
-        ).encode('utf8'))
+        uuid = binascii.hexlify(
+            struct.pack('>I', int(time.time())) + os.urandom(12)
+        ).decode('ascii')
+        self._q.put(_dumps([
+            uuid,
+            play_start,
+            duration,
+            0 if asset_id is None else asset_id,
+            asset_filename,
+        ]))
 
 class Device(object):
     def __init__(self, kv, api):
@@ -1502,6 +1959,9 @@ class Device(object):
         self._gpio = GPIO()
         self._kv = kv
         self._api = api
+        self._syncer_api = None
+        self._syncer_api_lock = threading.Lock()
+        self._screen_resolution = None
 
     @property
     def kv(self):
@@ -1517,8 +1977,14 @@ class Device(object):
 
     @property
     def screen_resolution(self):
-        with open("/sys/class/graphics/fb0/virtual_size", "rb") as f:
-            return [int(val) for val in f.read().strip().split(',')]
+        # The framebuffer size doesn't change while the service
+        # is running, so it's only read once.
+        if self._screen_resolution is None:
+            with open("/sys/class/graphics/fb0/virtual_size", "rb") as f:
+                self._screen_resolution = [
+                    int(val) for val in f.read().strip().split(',')
+                ]
+        return list(self._screen_resolution)
 
     @property
     def screen_w(self):
@@ -1530,7 +1996,10 @@ class Device(object):
 
     @property
     def syncer_api(self):
-        return SyncerAPI()
+        with self._syncer_api_lock:
+            if self._syncer_api is None:
+                self._syncer_api = SyncerAPI()
+            return self._syncer_api
 
     def ensure_connected(self):
         if self._socket:
@@ -1555,7 +2024,7 @@ class Device(object):
             self._socket = None
 
     def send_upstream(self, **data):
-        self.send_raw(json.dumps(data))
+        self.send_raw(_dumps(data))
 
     def turn_screen_off(self):
         self.send_raw("tv off")